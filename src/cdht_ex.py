@@ -13,12 +13,21 @@
 #! /usr/bin/python
 
 import sys
+import os
 import re
 import socket
 import time
 import threading
 import ctypes
 import struct
+import heapq
+import random
+import json
+import itertools
+import Queue
+import signal
+import hashlib
+import collections
 
 import curses
 import curses.ascii
@@ -31,13 +40,36 @@ BASE_PORT_OFFSET = 50000; #Port offset for connections. All monitoring occurs on
 PINGREQ_TIMEOUT = 1.0; # How long until sent ping over UDP will timeout
 PINGMONITOR_TIMEOUT = 1.0; #How long to wait for a ping response to come in
 PINGBUFFER = 4; #How much buffer space in bytes required to encapsulate a ping message
-TCPBUFFER = 6; #How much buffer space in bytes to allocate to incoming TCP messages
+TCPBUFFER = 4096; #How much buffer space in bytes to allocate to incoming TCP messages (large enough for a fully traced FT message)
 PINGSEND_FREQUENCY = 5.0; #How often to send a ping (seconds)
 FILEMONITOR_TIMEOUT = 1.0;  #How long to wait before terminating a TCP file transfer connection (handshaking stage)
 THREADKILLTIME = 2.0; #How long to wait before terminating program (to allow thread to terminate safely)
 MAXPEERNUM = 255; #Maximum number of peers in CDHT network
 SEQMAX = 65536; #Maximum sequence number (non inclusive). ie possible sequence numbers range from 0 - (SEQMAX - 1) before wrapping around to zero
 PING_MISSED_ACK_DEAD_NUM = 4; #Number of consecutive acks that are required for a peer to be declared as dead
+TCPBACKLOG = 16; #Number of pending TCP connections the listening socket will queue
+WORKQUEUE_SIZE = 32; #Maximum number of file requests waiting to be processed before this peer replies busy
+WORKER_POLL_INTERVAL = 0.1; #How long the worker thread waits for a queued file request before checking deferred retries
+BUSY_RETRY_AFTER = 0.25; #Retry-after time (seconds) sent in busy replies
+BUSY_MAX_RETRIES = 4; #Number of times a busy request is retried (with exponential backoff) before it is dropped
+BUSY_JITTER = 0.5; #Fraction of random jitter applied to each backoff delay
+CONTROL_SOCKET_FORMAT = "/tmp/cdht_{0}.sock"; #Unix domain control socket path ({0} is the peer ID)
+CONTROLBUFFER = 4096; #How much buffer space in bytes to allocate to incoming control socket data
+PENDING_EXPIRY = 30.0; #How long (seconds) a file request sent by this peer waits for its response before it times out
+CONTROLQUEUE_SIZE = 64; #Maximum number of control socket file requests waiting to be sent (readers block when it is full)
+INPUT_POLL_INTERVAL = 100; #How often (milliseconds) the input prompt stops waiting for a key to check for a quit from the control socket or a profiler signal
+PROFILE_INTERVAL = 0.005; #How often (seconds) the sampling profiler samples thread stacks
+PROFILE_FORMAT = "cdht_profile_{0}.folded"; #Collapsed stack file written when the profiler is stopped ({0} is the peer ID)
+PROFILE_SIGNAL = signal.SIGUSR1; #Signal that starts or stops the sampling profiler on a running peer
+STORE_MAX_KEYS = 64; #Maximum number of replicated or cached keys stored at a peer (oldest keys are evicted first)
+CACHE_RESPONSES = False; #Store a cached copy of every file this peer receives a response for (used to answer forwarded requests only)
+CACHE_EXPIRY = 60.0; #How long (seconds) a cached copy is used and advertised before it is forgotten
+BLOOM_BITS = 1024; #Size in bits of the key summary (Bloom filter) sent to neighbours, must be a multiple of 8
+BLOOM_HASHES = 3; #Number of hash functions used by key summaries
+SUMMARY_FREQUENCY = 5.0; #How often to send key summaries to successors and predecessors (seconds)
+SUMMARY_EXPIRY = 15.0; #How long a neighbours key summary is trusted after it is received (seconds)
+TRACE_MAX_HOPS = 255; #Maximum number of hop timestamps carried in a traced FT message (further hops are not recorded)
+TRACE_LOG_FORMAT = "cdht_trace_{0}.jsonl"; #Per peer trace log file that span records are appended to ({0} is the peer ID)
 
 #Curses vars
 CONTROL_WIDTH = 12;
@@ -53,11 +85,156 @@ def enum(**enums):
 # Enumns
 CONTROL = enum(STATUS=0, PINGREQ=1, PINGRES=2, FTREQ=3, FTRES=4, PEERCHURN=5, WARNING=6); #Control code signals
 Ping = enum(REQ=0, RES=1); # Type of Ping signals
-FT = enum(REQ=0, FORWARD=1, FORWARDNEXT=2, RES=3); #TCP Control codes
+FT = enum(REQ=0, FORWARD=1, FORWARDNEXT=2, RES=3, BUSY=7, SUMMARY=8, PROBE=9); #TCP Control codes
 PEERCHURN = enum(QUIT=4, QUERYREQ=5, QUERYRES=6); #TCP Control codes
 PEER = enum(INVALID=-1, DEAD=-2); # Peer special status codes
 FILECHECK = enum(NOTAVAILABLE=0, AVAILABLE=1, NEXTAVAILABLE = 2); #File availability status codes
 Colours = enum(STATUS=1, WARNING=2, COMMAND=3, RED=4, GREEN=5, FILETRANSFER=6, CHURN=7); #Colour identifiers for control code highlighting
+MESSAGE_NAMES = {FT.REQ: "ftreq", FT.FORWARD: "ftforward", FT.FORWARDNEXT: "ftforwardnext", FT.RES: "ftres", FT.SUMMARY: "summary", FT.PROBE: "ftprobe",
+                 PEERCHURN.QUIT: "churnquit", PEERCHURN.QUERYREQ: "churnqueryreq", PEERCHURN.QUERYRES: "churnqueryres"}; #TCP message names used in timing stats
+
+# Handler timing
+# Wall clock time spent in each message handler and send path is accumulated per name as [count, total, max] (seconds)
+handlerTimings = {};
+timingLock = threading.Lock();
+
+# Add the time elapsed since start to the timing stats of name
+def recordTiming(name, start):
+  elapsed = time.time() - start;
+
+  with timingLock:
+    stats = handlerTimings.get(name);
+    if stats is None:
+      handlerTimings[name] = [1, elapsed, elapsed];
+    else:
+      stats[0] += 1;
+      stats[1] += elapsed;
+      if elapsed > stats[2]:
+        stats[2] = elapsed;
+
+# Decorator that records the time spent in each call of the decorated function under name
+def timed(name):
+  def decorator(func):
+    def wrapper(*args, **kwargs):
+      start = time.time();
+      try:
+        return func(*args, **kwargs);
+      finally:
+        recordTiming(name, start);
+    wrapper.__name__ = func.__name__;
+    return wrapper;
+  return decorator;
+
+# Get a snapshot of the timing stats in milliseconds, optionally resetting them
+def getTimings(reset=False):
+  with timingLock:
+    timings = dict((name, {"count": stats[0], "total": round(stats[1] * 1000, 3), "mean": round(stats[1] * 1000 / stats[0], 3), "max": round(stats[2] * 1000, 3)})
+                   for name, stats in handlerTimings.items());
+    if reset:
+      handlerTimings.clear();
+  return timings;
+
+# Name used for timing stats of a TCP message type
+def messageName(msgType):
+  return MESSAGE_NAMES.get(msgType, "unknown");
+
+# Sampling profiler
+# While running, samples the stacks of all other threads every interval seconds and counts them as
+# collapsed stacks (thread;outer frame;...;inner frame) which flamegraph tools read directly
+class SamplingProfiler(object):
+
+  def __init__(self, interval):
+    self.interval = interval;
+    self.samples = {};
+    self.running = threading.Event();
+    self.thread = None;
+
+  def start(self):
+    if self.running.is_set():
+      return False;
+
+    self.samples = {};
+    self.running.set();
+    self.thread = threading.Thread(target=self.run, name="SamplingProfiler");
+    self.thread.daemon = True;
+    self.thread.start();
+    return True;
+
+  def stop(self):
+    if not self.running.is_set():
+      return False;
+
+    self.running.clear();
+    self.thread.join();
+    return True;
+
+  def run(self):
+    myIdent = threading.current_thread().ident;
+
+    while self.running.is_set():
+      threadNames = dict((thread.ident, thread.name) for thread in threading.enumerate());
+
+      for ident, frame in sys._current_frames().items():
+        if ident == myIdent:
+          continue;
+
+        stack = [];
+        while frame is not None:
+          code = frame.f_code;
+          stack.append(code.co_name + " (" + os.path.basename(code.co_filename) + ":" + str(code.co_firstlineno) + ")");
+          frame = frame.f_back;
+        stack.append(threadNames.get(ident, str(ident)));
+
+        key = ";".join(reversed(stack));
+        self.samples[key] = self.samples.get(key, 0) + 1;
+
+      time.sleep(self.interval);
+
+  # Write collapsed stacks (one "stack count" line per unique stack) to path
+  def dump(self, path):
+    with open(path, "w") as f:
+      for stack, count in sorted(self.samples.items()):
+        f.write(stack + " " + str(count) + "\n");
+    return sum(self.samples.values());
+
+profiler = SamplingProfiler(PROFILE_INTERVAL);
+
+# Start the sampling profiler, returns False if it was already running
+def startProfiler():
+  return profiler.start();
+
+# Stop the sampling profiler and dump its collapsed stacks
+# Returns (path, number of samples) or None if the profiler was not running
+def stopProfiler():
+  if not profiler.stop():
+    return None;
+
+  path = PROFILE_FORMAT.format(myPeer);
+  return (path, profiler.dump(path));
+
+# PROFILE_SIGNAL handler, only sets a flag as the handler may interrupt code holding a lock (eg. timingLock)
+# The input loop sees the flag within INPUT_POLL_INTERVAL and calls toggleProfiler
+def requestProfileToggle(signum, frame):
+  global profileToggleRequested;
+  profileToggleRequested = True;
+
+profileToggleRequested = False;
+
+# Start or stop the profiler (after PROFILE_SIGNAL was received)
+def toggleProfiler(screen):
+  global profileToggleRequested;
+  profileToggleRequested = False;
+
+  if startProfiler():
+    consolePrint(screen, CONTROL.STATUS, "Sampling profiler has been started.");
+    return;
+
+  try:
+    path, numSamples = stopProfiler();
+    consolePrint(screen, CONTROL.STATUS, "Sampling profiler has been stopped. " + str(numSamples) + " samples were written to " + path + ".");
+  except IOError:
+    consolePrint(screen, CONTROL.WARNING, "Sampling profiler has been stopped but its samples could not be written.");
+
 
 # Initialise application, check for valid arguments and initiate curses screen
 def init(argv):
@@ -75,7 +252,7 @@ def init(argv):
       exit(1);
 
   #Create important global variables required to keep peer in CDHT network
-  global myPeer, succ1, succ2, pred1, pred2, showPingMessages;
+  global myPeer, succ1, succ2, pred1, pred2, showPingMessages, traceRequests;
   
   myPeer = int(sys.argv[1]);
   succ1 = int(sys.argv[2]);
@@ -83,6 +260,7 @@ def init(argv):
   pred1 = PEER.INVALID; #predecessors will be set later based on incoming ping signals
   pred2 = PEER.INVALID;
   showPingMessages = True;
+  traceRequests = False; #attach trace IDs to file requests made at this peer
 
   curses.wrapper(main);
 
@@ -93,6 +271,7 @@ def init(argv):
 def main(screen):
   Y, X = screen.getmaxyx();
   global max_lines; #create global function for maximum number of lines that terminal can contain (based on terminal size)
+  global traceRequests;
   max_lines = (Y - 3)
 
   screen.clear();
@@ -127,13 +306,27 @@ def main(screen):
     consolePrint (screen, CONTROL.WARNING, makeColComp(Colours.RED, "A minimum terminal width of " + str(MIN_REC_WIDTH) + " characters is recommended (current: " + str(width) + ")."));
 
   # Start ping monitor (UDP) thread
-  tPingMonitor = threading.Thread(target=pingMonitor, args=(screen, Ping));
+  tPingMonitor = threading.Thread(target=pingMonitor, args=(screen, Ping), name="pingMonitor");
   tPingMonitor.start();
 
   #Start TCP monitor thread
-  tTCPMonitor = threading.Thread(target=TCPMonitor, args=(screen, Ping));
+  tTCPMonitor = threading.Thread(target=TCPMonitor, args=(screen, Ping), name="TCPMonitor");
   tTCPMonitor.start();
 
+  #Start file request worker thread
+  tTCPWorker = threading.Thread(target=TCPWorker, args=(screen,), name="TCPWorker");
+  tTCPWorker.start();
+
+  #Start control socket thread
+  tControlMonitor = threading.Thread(target=controlMonitor, args=(screen,), name="controlMonitor");
+  tControlMonitor.start();
+
+  #Start or stop the sampling profiler when PROFILE_SIGNAL is received (the input loop does the work)
+  signal.signal(PROFILE_SIGNAL, requestProfileToggle);
+
+  #Stop waiting for keys periodically so a quit from the control socket is noticed
+  screen.timeout(INPUT_POLL_INTERVAL);
+
   #Loop indefinitely waiting for input commands at stdin
   while True:
       #Capture string input
@@ -147,10 +340,13 @@ def main(screen):
 
         terminate_thread(tPingMonitor); #kill threads safely
         terminate_thread(tTCPMonitor);
+        terminate_thread(tTCPWorker);
+        terminate_thread(tControlMonitor);
+        removeControlSocket();
 
         consolePrint (screen, CONTROL.STATUS, "Leaving CDHT network and terminating program. Please wait for running threads to terminate."); #quit message
         screen.refresh()  #Display last message
-        time.sleep(THREADKILLTIME); #Pause to allow thread to terminate        
+        transport.sleep(THREADKILLTIME); #Pause to allow thread to terminate        
         break;
       elif s.startswith("request"):
         reqFileHash = "";
@@ -164,32 +360,12 @@ def main(screen):
           continue;
 
         #Ensure hash is valid
-        try:
-          reqFileHashNum = int(reqFileHash);
-      
-          # Check to see if integer is in valid range
-          if not (0 <= reqFileHashNum <= 9999) or len(reqFileHash) != 4:
-            raise ValueError('Invalid request file provided.') #throw exception
-        except:
+        reqFileHashNum = parseFileHash(reqFileHash);
+        if reqFileHashNum < 0:
           consolePrint (screen, CONTROL.STATUS, "Invalid file was requested. File name must be a 4 length numeral.");
           continue;
 
-        #Check if this file is available at the next peer
-        fileStatus = checkFileAvailable(reqFileHashNum);
-
-        if fileStatus == FILECHECK.NOTAVAILABLE:
-          #Send request normally
-          sendFTMessage(reqFileHashNum, FT.REQ, myPeer, LOCALHOST, peerToPort(succ1));
-        elif fileStatus == FILECHECK.AVAILABLE:
-          #File is stored locally
-          consolePrint (screen, CONTROL.FTRES,   "File " + makeColComp(Colours.RED, reqFileHash) + " is stored locally.");
-          continue;
-        elif fileStatus == FILECHECK.NEXTAVAILABLE:
-          # The next peer has the file, send a special message
-          sendFTMessage(reqFileHashNum, FT.FORWARDNEXT, myPeer, LOCALHOST, peerToPort(succ1));
-
-        # Display file request sent message
-        consolePrint (screen, CONTROL.FTREQ,   "File request message for " + makeColComp(Colours.RED, reqFileHash) + " has been sent to successor Peer (" + makeColComp(Colours.GREEN, str(succ1)) + ").");
+        requestFile(screen, reqFileHashNum);
 
       elif s.startswith("ping"):
         command = "";
@@ -213,6 +389,45 @@ def main(screen):
         else:
           consolePrint (screen, CONTROL.STATUS, "Invalid command parameters were provided. Provided command was: " + s);
 
+      elif s.startswith("store"):
+        reqFileHash = "";
+
+        #Get file store parameter
+        try:
+          reqFileHash = s.split()[1];
+        except:
+          consolePrint (screen, CONTROL.STATUS, "Invalid command parameters were provided. Provided command was: " + s);
+          continue;
+
+        #Ensure hash is valid
+        reqFileHashNum = parseFileHash(reqFileHash);
+        if reqFileHashNum < 0:
+          consolePrint (screen, CONTROL.STATUS, "Invalid file was provided. File name must be a 4 length numeral.");
+          continue;
+
+        storeKey(reqFileHashNum);
+        consolePrint (screen, CONTROL.STATUS, "File " + makeColComp(Colours.RED, reqFileHash) + " is now stored at this peer.");
+
+      elif s.startswith("trace"):
+        command = "";
+
+        #Get trace parameter
+        try:
+          command = s.split()[1];
+        except:
+          consolePrint (screen, CONTROL.STATUS, "Invalid command parameters were provided. Provided command was: " + s);
+          continue;
+
+        #Set request tracing to on or off
+        if command == "off":
+          consolePrint (screen, CONTROL.STATUS, "Request tracing has been disabled.");
+          traceRequests = False;
+        elif command == "on":
+          consolePrint (screen, CONTROL.STATUS, "Request tracing has been enabled. Spans are written to " + TRACE_LOG_FORMAT.format(myPeer) + ".");
+          traceRequests = True;
+        else:
+          consolePrint (screen, CONTROL.STATUS, "Invalid command parameters were provided. Provided command was: " + s);
+
       # Unknown command
       else:
         consolePrint (screen, CONTROL.STATUS, "Invalid command '" + s + "' provided.");
@@ -221,6 +436,70 @@ def main(screen):
       overflowCheck(screen);
       screen.refresh();
 
+# Convert a requested file name to its hash
+# Returns -1 if the file name is not a 4 length numeral
+def parseFileHash(reqFileHash):
+  try:
+    reqFileHash = str(reqFileHash);
+  except UnicodeError:
+    return -1;
+
+  if len(reqFileHash) != 4 or not str.isdigit(reqFileHash):
+    return -1;
+
+  return int(reqFileHash);
+
+# Send a file request for reqFileHashNum from this peer to the network
+# client, cmdID - control client (and command id) the response is streamed to, None to print it on the console
+# (control socket requests do not print the request sent message)
+# Returns the peer the request was sent to, myPeer if the file is stored locally or PEER.INVALID if the
+# request was deferred
+@timed("request")
+def requestFile(screen, reqFileHashNum, client=None, cmdID=None):
+  reqFileHash = str(reqFileHashNum).zfill(4);
+  quiet = client is not None;
+
+  #Check if this file is available at the next peer
+  fileStatus = checkFileAvailable(reqFileHashNum, False);
+
+  #Start a new trace for this request if tracing is enabled
+  trace = None;
+  if traceRequests:
+    trace = (rand.randint(1, 0xFFFFFFFF), []);
+
+  if fileStatus == FILECHECK.AVAILABLE:
+    #File is stored locally
+    if not quiet:
+      consolePrint (screen, CONTROL.FTRES,   "File " + makeColComp(Colours.RED, reqFileHash) + " is stored locally.");
+    return myPeer;
+
+  #Wait for the response, registered before sending so a fast response can not arrive first
+  token = addPendingRequest(reqFileHashNum, client, cmdID);
+
+  #This peer is the first hop, the request span starts when the request is sent like every other span
+  trace = addTraceHop(trace);
+
+  if fileStatus == FILECHECK.NOTAVAILABLE:
+    holder = findKeyHolder(reqFileHashNum);
+
+    if holder != PEER.INVALID:
+      #A neighbours key summary says it holds the file, ask it directly
+      nextPeer = sendFTRequest(screen, reqFileHashNum, FT.PROBE, myPeer, holder, trace, 0, token);
+    else:
+      #Send request normally
+      nextPeer = sendFTRequest(screen, reqFileHashNum, FT.REQ, myPeer, succ1, trace, 0, token);
+  elif fileStatus == FILECHECK.NEXTAVAILABLE:
+    # The next peer has the file, send a special message
+    nextPeer = sendFTRequest(screen, reqFileHashNum, FT.FORWARDNEXT, myPeer, succ1, trace, 0, token);
+
+  writeTraceSpan(trace, "request", reqFileHashNum, None, nextPeer);
+
+  # Display file request sent message (deferred requests are reported by sendFTRequest)
+  if nextPeer != PEER.INVALID and not quiet:
+    consolePrint (screen, CONTROL.FTREQ,   "File request message for " + makeColComp(Colours.RED, reqFileHash) + " has been sent to " + ("successor " if nextPeer in (succ1, succ2) else "") + "Peer (" + makeColComp(Colours.GREEN, str(nextPeer)) + ").");
+
+  return nextPeer;
+
 # Check if text has overflown and adjust screen accordingly
 def overflowCheck(screen):
   global lines;
@@ -262,6 +541,10 @@ def input(screen):
         elif c in PRINTABLE:
             s.append(chr(c));
             screen.addch(c);
+        elif c == curses.ERR and quitRequested.is_set(): #no key pressed but a quit was requested over the control socket
+            return "quit";
+        elif c == curses.ERR and profileToggleRequested: #no key pressed but PROFILE_SIGNAL was received
+            toggleProfiler(screen);
         else:
             pass
 
@@ -303,11 +586,10 @@ def pingMonitor(screen, Ping):
   global myPeer, succ1, succ2, pred1, pred2, lastDeadPeer;
 
   # Create socket that is to be used for listening for messages
-  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM);
-  sock.settimeout(PINGMONITOR_TIMEOUT);
-  sock.bind((LOCALHOST, peerToPort(myPeer)));
+  sock = transport.listenDatagram(LOCALHOST, peerToPort(myPeer), PINGMONITOR_TIMEOUT);
 
   lastPingsSent = 0;
+  lastSummariesSent = 0;
 
   #Sequence numbers (Go from 0-SEQMAX-1)
   sequenceNum = 0;
@@ -318,7 +600,7 @@ def pingMonitor(screen, Ping):
 
   while True:
     # Send pings to successors at each PINGSENDTIME timestep
-    if (time.time() - lastPingsSent) > PINGSEND_FREQUENCY:
+    if (transport.time() - lastPingsSent) > PINGSEND_FREQUENCY:
       # Send pings requests to each successor if they are not dead
       if succ1 != PEER.DEAD:
         sendPing(Ping.REQ, sequenceNum, myPeer, LOCALHOST, peerToPort(succ1));
@@ -328,7 +610,18 @@ def pingMonitor(screen, Ping):
       sequenceNum = (sequenceNum + 1) % SEQMAX; #increment sequence number, wrapping to 0 if neccessary
 
       #Update lastPingsSent time
-      lastPingsSent = time.time();
+      lastPingsSent = transport.time();
+
+    # Send key summaries to successors and predecessors at each SUMMARY_FREQUENCY timestep
+    if (transport.time() - lastSummariesSent) > SUMMARY_FREQUENCY:
+      with storeLock:
+        expireCachedKeys();
+
+      for peerID in set([succ1, succ2, pred1, pred2]):
+        if peerID >= 0 and peerID != myPeer:
+          sendSummaryMessage(keySummary, myPeer, LOCALHOST, peerToPort(peerID));
+
+      lastSummariesSent = transport.time();
 
     #If a successor has recently died and we have a new successor
     #Reset the sequence number so new successor is not instantly declared dead also
@@ -380,7 +673,8 @@ def pingMonitor(screen, Ping):
     # Monitor listen port for incoming ping messages
     try:
       data, addr = sock.recvfrom(PINGBUFFER);
-      
+      start = time.time();
+
       msgType = ord(data[0]); # get message type
       senderPeerID = int(struct.unpack("B", data[1])[0]); #get senders ID
       recSeq = int(struct.unpack("H", data[2:4])[0]); #get ping sequence number
@@ -415,6 +709,8 @@ def pingMonitor(screen, Ping):
 
         #Print response received message
         consolePrint(screen, CONTROL.PINGRES , "A ping response message was received from Peer (" + makeColComp(Colours.GREEN, str(senderPeerID))+ ")")
+
+      recordTiming("udp.pingreq" if msgType == Ping.REQ else "udp.pingres", start);
     except socket.error:
       pass;
 
@@ -425,20 +721,27 @@ def TCPMonitor(screen, Ping):
   global myPeer, succ1, succ2, lastDeadPeer;
 
   # Create socket that is to be used for listening for messages
-  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM);
-  sock.settimeout(FILEMONITOR_TIMEOUT);
-  sock.bind((LOCALHOST, peerToPort(myPeer)));
-  sock.listen(1);  
+  sock = transport.listenStream(LOCALHOST, peerToPort(myPeer), FILEMONITOR_TIMEOUT, TCPBACKLOG);
 
   # Continuously monitor for file transfer requests
   while True:
     try:
       conn, addr = sock.accept();
 
-      while True:
-        data = conn.recv(TCPBUFFER);
-        if not data: break
-
+      #Read the whole message before parsing it, senders write one message per connection and then close
+      #(or shut down) their side. Incomplete messages (sender stalled) are dropped
+      data = "";
+      conn.settimeout(FILEMONITOR_TIMEOUT);
+      try:
+        while len(data) < TCPBUFFER:
+          chunk = conn.recv(TCPBUFFER - len(data));
+          if not chunk: break
+          data += chunk;
+      except socket.timeout:
+        data = "";
+
+      if len(data) >= 4:
+        start = time.time();
         msgType = ord(data[0]); # get message type
         senderPeerID = int(struct.unpack("B", data[1])[0]); #get senders ID
         
@@ -491,47 +794,791 @@ def TCPMonitor(screen, Ping):
           consolePrint(screen, CONTROL.PEERCHURN, "My first successor is now Peer (" + makeColComp(Colours.GREEN, str(succ1))  + ").");
           consolePrint(screen, CONTROL.PEERCHURN, "My second successor is now Peer (" + makeColComp(Colours.GREEN, str(succ2))  + ").");
 
+        # A neighbour has sent a summary of the keys it stores (summaries of the wrong size are ignored)
+        elif msgType == FT.SUMMARY:
+          if len(data) == 2 + BLOOM_BITS / 8:
+            neighbourSummaries[senderPeerID] = (bytearray(data[2:]), transport.time());
+
         else:
           #File transfer message
           filehash = int(struct.unpack("H", data[2:4])[0]); # get file hash
-
-          #Predecessor peer has detected we have file, send response
-          if msgType == FT.FORWARDNEXT:
-            # We have the file
-            # Directory contact sender with response
-            sendFTMessage(filehash, FT.RES, myPeer, LOCALHOST, peerToPort(senderPeerID));
-            consolePrint(screen, CONTROL.FTRES, "File " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " is stored here. A response message has been sent to Peer (" + makeColComp(Colours.GREEN, str(senderPeerID))  + ").");
+          trace = unpackTrace(data); # get trace information (if message is traced)
+          recvTime = transport.time();
 
           #We received a response for a requested file request
-          elif msgType == FT.RES:
-            consolePrint(screen, CONTROL.FTRES, "Received a response message from Peer (" + makeColComp(Colours.GREEN, str(senderPeerID))  + "), which has the file " + makeColComp(Colours.RED, str(filehash).zfill(4)) + ".");
+          #Responses to control socket requests are streamed to the control client instead of printed
+          if msgType == FT.RES:
+            if CACHE_RESPONSES:
+              storeKey(filehash, transport.time() + CACHE_EXPIRY);
+
+            if not completePendingRequest(filehash, senderPeerID, recvTime, None, screen):
+              consolePrint(screen, CONTROL.FTRES, "Received a response message from Peer (" + makeColComp(Colours.GREEN, str(senderPeerID))  + "), which has the file " + makeColComp(Colours.RED, str(filehash).zfill(4)) + ".");
+
+            if trace is not None:
+              writeTraceSpan(trace, "response", filehash, recvTime, PEER.INVALID);
+              traceID, hops = trace;
+              consolePrint(screen, CONTROL.STATUS, "Trace " + ("%08x" % traceID) + " completed in " + ("%.3f" % ((recvTime - hops[0][1]) * 1000)) + " ms over " + str(len(hops)) + " hops.");
 
-          #Else perform regular processing
+          #File requests are queued for the worker thread, reply busy if the queue is full
           else:
-            #Check if this file is available here
-            fileStatus = checkFileAvailable(str(filehash));
-
-            if fileStatus == FILECHECK.NOTAVAILABLE:
-              #Forward message to successor
-              sendFTMessage(filehash, FT.FORWARD, senderPeerID, LOCALHOST, peerToPort(succ1));
-              consolePrint(screen, CONTROL.FTREQ, "File " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " is not stored here. File request message has been forwarded to successor Peer (" + makeColComp(Colours.GREEN, str(succ1))  + ").");
-
-            elif fileStatus == FILECHECK.AVAILABLE:
-              # We have the file
-              # Directory contact sender with response
-              sendFTMessage(filehash, FT.RES, myPeer, LOCALHOST, peerToPort(senderPeerID));
-              consolePrint(screen, CONTROL.FTRES, "File " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " is stored here. A response message has been sent to Peer (" + makeColComp(Colours.GREEN, str(succ1))  + ").");
-        
-            elif fileStatus == FILECHECK.NEXTAVAILABLE:
-              # The next peer has the file, send a special message
-              sendFTMessage(filehash, FT.FORWARDNEXT, senderPeerID, LOCALHOST, peerToPort(succ1));
-              consolePrint(screen, CONTROL.FTREQ, "File " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " is not stored here. File request message has been forwarded to successor Peer (" + makeColComp(Colours.GREEN, str(succ1))  + ").");
+            try:
+              transport.putQueued(workQueue, (msgType, senderPeerID, filehash, trace, recvTime));
+            except Queue.Full:
+              conn.send(makeBusyMessage(filehash));
+              consolePrint(screen, CONTROL.WARNING, "This peer is overloaded. File request message for " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " has been rejected (busy).");
+
+        recordTiming("tcp." + messageName(msgType), start);
 
       conn.close();
-    except socket.error:
+    except (socket.error, struct.error): #malformed messages are ignored
       pass;
 
 
+# File request worker thread
+# Processes file requests queued by the TCP monitor and resends deferred (busy) requests once they are due
+def TCPWorker(screen):
+  lastExpiryCheck = 0;
+
+  while True:
+    # Time out requests sent by this peer whose response never came
+    if transport.time() - lastExpiryCheck >= WORKER_POLL_INTERVAL:
+      expirePendingRequests(screen);
+      lastExpiryCheck = transport.time();
+
+    # Resend deferred requests that are due, to wherever they should go now (successors may have changed)
+    for filehash, msgType, sourceID, targetPeer, trace, attempt, token in popDueRetries():
+      #Responses always go back to the requester
+      if msgType == FT.RES:
+        sendFTResponse(screen, filehash, targetPeer, trace, attempt);
+        continue;
+
+      msgType, targetPeer = resolveRetry(filehash, msgType, targetPeer, sourceID != myPeer);
+
+      if targetPeer == myPeer:
+        #The file has since been stored here (eg. cached), answer the request directly
+        if sourceID != myPeer:
+          sendFTResponse(screen, filehash, sourceID, addTraceHop(trace));
+        elif not completePendingRequest(filehash, myPeer, transport.time(), token, screen):
+          consolePrint(screen, CONTROL.FTRES, "File " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " is stored locally.");
+        writeTraceSpan(trace, "owner", filehash, None, sourceID);
+        continue;
+
+      nextPeer = sendFTRequest(screen, filehash, msgType, sourceID, targetPeer, trace, attempt, token);
+      writeTraceSpan(trace, "retry", filehash, None, nextPeer);
+
+    try:
+      msgType, senderPeerID, filehash, trace, recvTime = transport.getQueued(workQueue, WORKER_POLL_INTERVAL);
+    except Queue.Empty:
+      continue;
+
+    start = time.time();
+
+    #Predecessor peer has detected we have file, send response
+    if msgType == FT.FORWARDNEXT:
+      # We have the file
+      # Directory contact sender with response
+      sendFTResponse(screen, filehash, senderPeerID, addTraceHop(trace));
+      writeTraceSpan(trace, "owner", filehash, recvTime, senderPeerID);
+      consolePrint(screen, CONTROL.FTRES, "File " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " is stored here. A response message has been sent to Peer (" + makeColComp(Colours.GREEN, str(senderPeerID))  + ").");
+
+    #Else perform regular processing
+    else:
+      #Check if this file is available here
+      fileStatus = checkFileAvailable(str(filehash));
+
+      if fileStatus == FILECHECK.NOTAVAILABLE:
+        #A probe that missed (key summary false positive) keeps walking as a probe without using summaries again,
+        #so it can never bounce between neighbours
+        holder = PEER.INVALID;
+        if msgType != FT.PROBE:
+          holder = findKeyHolder(filehash);
+
+        if holder != PEER.INVALID:
+          #A neighbours key summary says it holds the file, send the request straight to it
+          nextPeer = sendFTRequest(screen, filehash, FT.PROBE, senderPeerID, holder, addTraceHop(trace));
+          writeTraceSpan(trace, "forward", filehash, recvTime, nextPeer);
+          if nextPeer != PEER.INVALID:
+            consolePrint(screen, CONTROL.FTREQ, "File " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " is not stored here. File request message has been sent to Peer (" + makeColComp(Colours.GREEN, str(nextPeer))  + "), whose key summary holds it.");
+        else:
+          #Forward message to successor
+          nextPeer = sendFTRequest(screen, filehash, FT.PROBE if msgType == FT.PROBE else FT.FORWARD, senderPeerID, succ1, addTraceHop(trace));
+          writeTraceSpan(trace, "forward", filehash, recvTime, nextPeer);
+          if nextPeer != PEER.INVALID:
+            consolePrint(screen, CONTROL.FTREQ, "File " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " is not stored here. File request message has been forwarded to successor Peer (" + makeColComp(Colours.GREEN, str(nextPeer))  + ").");
+
+      elif fileStatus == FILECHECK.AVAILABLE:
+        # We have the file
+        # Directory contact sender with response
+        sendFTResponse(screen, filehash, senderPeerID, addTraceHop(trace));
+        writeTraceSpan(trace, "owner", filehash, recvTime, senderPeerID);
+        consolePrint(screen, CONTROL.FTRES, "File " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " is stored here. A response message has been sent to Peer (" + makeColComp(Colours.GREEN, str(succ1))  + ").");
+
+      elif fileStatus == FILECHECK.NEXTAVAILABLE:
+        # The next peer has the file, send a special message
+        nextPeer = sendFTRequest(screen, filehash, FT.FORWARDNEXT, senderPeerID, succ1, addTraceHop(trace));
+        writeTraceSpan(trace, "forward", filehash, recvTime, nextPeer);
+        if nextPeer != PEER.INVALID:
+          consolePrint(screen, CONTROL.FTREQ, "File " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " is not stored here. File request message has been forwarded to successor Peer (" + makeColComp(Colours.GREEN, str(nextPeer))  + ").");
+
+    recordTiming("worker." + messageName(msgType), start);
+
+workQueue = Queue.Queue(WORKQUEUE_SIZE); #Bounded queue of (msgType, senderPeerID, filehash, trace, recvTime) file requests
+retryQueue = []; #Heap of (due time, order, request) file requests (and responses) deferred because their target was busy or unreachable
+retryLock = threading.Lock();
+retryOrder = itertools.count();
+rand = random.Random(); #Random numbers for backoff jitter and trace IDs (seeded per peer by the simulator)
+
+# Work out where a deferred file request should be resent, returns (msgType, targetPeer)
+# A probe still goes to the neighbour whose key summary matched if that peer is still a neighbour. Every other request
+# goes to the current first (or, while it is being replaced, second) successor, as FORWARDNEXT only if the first
+# successor now owns the file.
+# targetPeer is this peer if the file is now stored here (cached copies only count when includeCached is set)
+def resolveRetry(filehash, msgType, targetPeer, includeCached):
+  if msgType == FT.PROBE and targetPeer in (succ1, succ2, pred1, pred2):
+    return (msgType, targetPeer);
+
+  #First successor is dead and not yet replaced, go through the second successor
+  if succ1 < 0:
+    return (FT.PROBE if msgType == FT.PROBE else FT.FORWARD, succ2);
+
+  fileStatus = checkFileAvailable(filehash, includeCached);
+
+  if fileStatus == FILECHECK.AVAILABLE:
+    return (msgType, myPeer);
+  elif fileStatus == FILECHECK.NEXTAVAILABLE:
+    return (FT.FORWARDNEXT, succ1);
+  elif msgType == FT.FORWARDNEXT:
+    return (FT.FORWARD, succ1);
+  return (msgType, succ1);
+
+# Add a file request to be resent at time due
+def deferRetry(due, request):
+  with retryLock:
+    heapq.heappush(retryQueue, (due, next(retryOrder), request));
+
+# Remove and return all deferred file requests that are due
+def popDueRetries():
+  due = [];
+  with retryLock:
+    while retryQueue and retryQueue[0][0] <= transport.time():
+      due.append(heapq.heappop(retryQueue)[2]);
+  return due;
+
+
+# Control socket thread
+# Accepts local clients on a Unix domain socket so peers can be driven without the curses prompt.
+# Clients send newline delimited JSON commands and receive newline delimited JSON replies:
+#   {"id": 1, "cmd": "request", "file": "2012"} -> {"id": 1, "ok": true, "status": "sent", "peer": 3}
+#     followed later by {"id": 1, "event": "response", "file": "2012", "peer": 12, "elapsed": 1.2}
+#     or by {"id": 1, "event": "dropped", "file": "2012"} if the request was dropped after BUSY_MAX_RETRIES retries
+#     or by {"id": 1, "event": "timeout", "file": "2012"} if no response arrived within PENDING_EXPIRY seconds
+#     (status is local if the file is stored here or deferred if the successor was busy or unreachable)
+#   {"id": 2, "cmd": "status"} -> {"id": 2, "ok": true, "peer": 1, "succ1": 3, ..., "workQueue": 0, ...}
+#   {"id": 3, "cmd": "neighbours"} -> {"id": 3, "ok": true, "succ1": 3, "succ2": 4, "pred1": 15, "pred2": 12}
+#   {"id": 4, "cmd": "quit"} -> {"id": 4, "ok": true}, then the peer leaves the network
+#   {"id": 5, "cmd": "timings", "reset": false} -> {"id": 5, "ok": true, "timings": {"send.ft": {"count": 3, "mean": 0.2, ...}, ...}}
+#   {"id": 6, "cmd": "profile", "action": "start"} -> {"id": 6, "ok": true}
+#   {"id": 7, "cmd": "profile", "action": "stop"} -> {"id": 7, "ok": true, "path": "cdht_profile_1.folded", "samples": 812}
+#   {"id": 8, "cmd": "store", "file": "2012"} -> {"id": 8, "ok": true} (file is stored at this peer as a replica)
+# Commands may be pipelined, replies always carry the id of the command they belong to.
+def controlMonitor(screen):
+  path = CONTROL_SOCKET_FORMAT.format(myPeer);
+  removeControlSocket();
+
+  # Create socket that is to be used for listening for control clients
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM);
+  sock.settimeout(FILEMONITOR_TIMEOUT);
+  sock.bind(path);
+  sock.listen(TCPBACKLOG);
+
+  # File requests are sent by a single worker so client reader threads never wait on the network
+  tRequestWorker = threading.Thread(target=controlRequestWorker, args=(screen,), name="controlRequestWorker");
+  tRequestWorker.daemon = True;
+  tRequestWorker.start();
+
+  while True:
+    try:
+      conn, addr = sock.accept();
+    except socket.error:
+      continue;
+
+    # Serve each client on its own thread so slow clients do not block others
+    tClient = threading.Thread(target=controlClient, args=(screen, ControlClient(conn)));
+    tClient.daemon = True;
+    tClient.start();
+
+# Connected control socket client, writes from different threads are serialised by lock
+# Replies to a client that has disconnected are discarded
+class ControlClient(object):
+
+  def __init__(self, conn):
+    self.conn = conn;
+    self.lock = threading.Lock();
+    self.closed = False;
+
+  def send(self, reply):
+    with self.lock:
+      if self.closed:
+        return;
+      try:
+        self.conn.sendall(json.dumps(reply) + "\n");
+      except socket.error:
+        pass;
+
+  def close(self):
+    with self.lock:
+      self.closed = True;
+      self.conn.close();
+
+# Read newline delimited commands from a control client until it disconnects
+def controlClient(screen, client):
+  buf = "";
+
+  while True:
+    try:
+      data = client.conn.recv(CONTROLBUFFER);
+    except socket.error:
+      break;
+    if not data: break
+
+    buf += data;
+    while "\n" in buf:
+      line, buf = buf.split("\n", 1);
+      if not line.strip():
+        continue;
+
+      #A command that fails must not end the client session
+      try:
+        handleControlCommand(screen, client, line);
+      except Exception as e:
+        client.send({"id": None, "ok": False, "error": "command failed: " + repr(e)});
+
+  # Requests still pending for this client stay queued so later responses are matched in order, their replies are discarded
+  client.close();
+
+# Process a single control command and send its reply
+def handleControlCommand(screen, client, line):
+  try:
+    command = json.loads(line);
+  except ValueError:
+    client.send({"id": None, "ok": False, "error": "invalid command: " + line.decode("utf-8", "replace")});
+    return;
+
+  cmdID = command.get("id") if isinstance(command, dict) else None;
+  if not isinstance(command, dict) or "cmd" not in command:
+    client.send({"id": cmdID, "ok": False, "error": "invalid command: " + line.decode("utf-8", "replace")});
+    return;
+
+  cmd = command["cmd"];
+
+  if cmd == "request":
+    reqFileHashNum = parseFileHash(command.get("file", ""));
+    if reqFileHashNum < 0:
+      client.send({"id": cmdID, "ok": False, "error": "file name must be a 4 length numeral"});
+      return;
+
+    #Sent (and acknowledged) by the control request worker, blocks this reader while the queue is full
+    controlRequests.put((client, cmdID, reqFileHashNum));
+
+  elif cmd == "status":
+    with pendingLock:
+      pending = sum(len(waiters) for waiters in pendingRequests.values());
+    client.send({"id": cmdID, "ok": True, "peer": myPeer, "succ1": succ1, "succ2": succ2, "pred1": pred1, "pred2": pred2,
+                 "workQueue": workQueue.qsize(), "retries": len(retryQueue), "pending": pending, "tracing": traceRequests,
+                 "storedKeys": len(storedKeys), "summaries": sorted(neighbourSummaries.keys())});
+
+  elif cmd == "store":
+    reqFileHashNum = parseFileHash(command.get("file", ""));
+    if reqFileHashNum < 0:
+      client.send({"id": cmdID, "ok": False, "error": "file name must be a 4 length numeral"});
+      return;
+
+    storeKey(reqFileHashNum);
+    client.send({"id": cmdID, "ok": True});
+
+  elif cmd == "neighbours":
+    client.send({"id": cmdID, "ok": True, "succ1": succ1, "succ2": succ2, "pred1": pred1, "pred2": pred2});
+
+  elif cmd == "quit":
+    client.send({"id": cmdID, "ok": True});
+    quitRequested.set();
+
+  elif cmd == "timings":
+    client.send({"id": cmdID, "ok": True, "timings": getTimings(bool(command.get("reset")))});
+
+  elif cmd == "profile":
+    action = command.get("action");
+
+    if action == "start":
+      client.send({"id": cmdID, "ok": startProfiler()});
+    elif action == "stop":
+      try:
+        result = stopProfiler();
+      except IOError as e:
+        client.send({"id": cmdID, "ok": False, "error": "could not write profile: " + str(e)});
+        return;
+
+      if result is None:
+        client.send({"id": cmdID, "ok": False, "error": "profiler is not running"});
+      else:
+        client.send({"id": cmdID, "ok": True, "path": result[0], "samples": result[1]});
+    else:
+      client.send({"id": cmdID, "ok": False, "error": "profile action must be start or stop"});
+
+  else:
+    client.send({"id": cmdID, "ok": False, "error": "unknown command: " + repr(cmd)});
+
+# Control request worker thread
+# Sends file requests queued by control clients and acknowledges them
+def controlRequestWorker(screen):
+  while True:
+    client, cmdID, reqFileHashNum = controlRequests.get();
+    nextPeer = requestFile(screen, reqFileHashNum, client, cmdID);
+
+    if nextPeer == myPeer:
+      client.send({"id": cmdID, "ok": True, "status": "local"});
+    elif nextPeer == PEER.INVALID:
+      client.send({"id": cmdID, "ok": True, "status": "deferred"});
+    else:
+      client.send({"id": cmdID, "ok": True, "status": "sent", "peer": nextPeer});
+
+# Pending file requests
+# Every file request sent by this peer (from the prompt or a control client) waits in a per file FIFO until its
+# response arrives, it is dropped or it times out after PENDING_EXPIRY seconds. Requests for the same file are
+# answered in the order they were sent, skipping requests that have timed out.
+
+# Add a request for filehash that is waiting for a response (client is None for prompt requests)
+# Returns the token identifying the request, which deferred retries of the request carry
+def addPendingRequest(filehash, client, cmdID):
+  token = next(requestTokens);
+  with pendingLock:
+    pendingRequests.setdefault(filehash, collections.deque()).append((token, client, cmdID, transport.time()));
+  return token;
+
+# Remove and return the request waiting on filehash with the given token (the oldest if token is None)
+# Returns None if no such request is waiting
+def popPendingRequest(filehash, token=None):
+  with pendingLock:
+    waiters = pendingRequests.get(filehash);
+    if not waiters:
+      return None;
+
+    if token is None:
+      waiter = waiters.popleft();
+    else:
+      waiter = next((waiter for waiter in waiters if waiter[0] == token), None);
+      if waiter is None:
+        return None;
+      waiters.remove(waiter);
+
+    if not waiters:
+      del pendingRequests[filehash];
+    return waiter;
+
+# Complete a request waiting on filehash (the oldest, or the one with token) with a response from peerID
+# Control requests are streamed the response, returns False if the response should be printed on the console instead
+def completePendingRequest(filehash, peerID, recvTime, token=None, screen=None):
+  expirePendingRequests(screen, filehash);
+
+  waiter = popPendingRequest(filehash, token);
+  if waiter is None or waiter[1] is None:
+    return False;
+
+  token, client, cmdID, sentAt = waiter;
+  client.send({"id": cmdID, "event": "response", "file": str(filehash).zfill(4), "peer": peerID, "elapsed": round((recvTime - sentAt) * 1000, 3)});
+  return True;
+
+# The request with token has been dropped, tell its control client (prompt requests have already been told)
+def dropPendingRequest(filehash, token):
+  waiter = popPendingRequest(filehash, token);
+  if waiter is not None and waiter[1] is not None:
+    token, client, cmdID, sentAt = waiter;
+    client.send({"id": cmdID, "event": "dropped", "file": str(filehash).zfill(4)});
+
+# Time out the requests (waiting on filehash, or on any file) that have waited longer than PENDING_EXPIRY
+# Control clients are sent a timeout event, prompt requests are reported on the console
+def expirePendingRequests(screen, filehash=None):
+  expired = [];
+  now = transport.time();
+
+  with pendingLock:
+    for key in ([filehash] if filehash is not None else pendingRequests.keys()):
+      waiters = pendingRequests.get(key);
+      if waiters is None:
+        continue;
+
+      # Requests are queued in the order they were sent, so expired requests are always at the front
+      while waiters and now - waiters[0][3] >= PENDING_EXPIRY:
+        expired.append((key, waiters.popleft()));
+      if not waiters:
+        del pendingRequests[key];
+
+  for key, (token, client, cmdID, sentAt) in expired:
+    if client is not None:
+      client.send({"id": cmdID, "event": "timeout", "file": str(key).zfill(4)});
+    elif screen is not None:
+      consolePrint(screen, CONTROL.WARNING, "No response was received for the file request for " + makeColComp(Colours.RED, str(key).zfill(4)) + ". The request has timed out.");
+
+# Remove this peers control socket file
+def removeControlSocket():
+  try:
+    os.unlink(CONTROL_SOCKET_FORMAT.format(myPeer));
+  except OSError:
+    pass;
+
+pendingRequests = {}; #Maps file hash to a deque of (token, control client or None, command id, send time) requests waiting for a response
+pendingLock = threading.Lock();
+requestTokens = itertools.count(1);
+controlRequests = Queue.Queue(CONTROLQUEUE_SIZE); #Bounded queue of (client, command id, filehash) control file requests
+quitRequested = threading.Event(); #Set when a control client asks this peer to quit
+
+
+# Transport Layer
+# All network I/O (and the clock used for timing) goes through the active transport so the peer logic
+# does not depend on real sockets. SocketTransport is the real UDP/TCP implementation, MemoryTransport
+# is an in-process queue based transport driven by a VirtualClock with injectable loss and latency.
+# Listening objects returned by a transport must support recvfrom(bufsize) (datagram) or
+# accept() -> (conn, addr) (stream) and raise socket.timeout when nothing arrives in time.
+# Stream connections support settimeout, recv, send (reply to the sender) and close. sendStream returns the reply
+# written by the receiver before it closed the connection when awaitReply is set.
+# Queues shared by the threads of a peer are also used through the transport (putQueued, getQueued) so a blocked
+# thread is always waiting on the transport clock.
+
+# Real UDP/TCP transport using the system clock
+class SocketTransport(object):
+
+  def time(self):
+    return time.time();
+
+  def sleep(self, secs):
+    time.sleep(secs);
+
+  def listenDatagram(self, ip, port, timeout):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM);
+    sock.settimeout(timeout);
+    sock.bind((ip, port));
+    return sock;
+
+  def listenStream(self, ip, port, timeout, backlog):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM);
+    sock.settimeout(timeout);
+    sock.bind((ip, port));
+    sock.listen(backlog);
+    return sock;
+
+  def sendDatagram(self, message, targetIP, targetPort):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); #UDP
+    sock.settimeout(PINGREQ_TIMEOUT);
+    sock.sendto(message, (targetIP, targetPort));
+    sock.close();
+
+  def sendStream(self, message, targetIP, targetPort, awaitReply=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM);
+    sock.connect((targetIP, targetPort));
+    sock.sendall(message);
+
+    #Signal end of message and wait for the receiver to reply or close the connection
+    reply = "";
+    if awaitReply:
+      sock.shutdown(socket.SHUT_WR);
+      sock.settimeout(FILEMONITOR_TIMEOUT);
+      try:
+        reply = sock.recv(TCPBUFFER);
+      except socket.timeout:
+        pass;
+
+    sock.close();
+    return reply;
+
+  def putQueued(self, queue, item):
+    queue.put_nowait(item);
+
+  # Block up to timeout for an item of queue, raises Queue.Empty if none arrives in time
+  def getQueued(self, queue, timeout):
+    return queue.get(True, timeout);
+
+
+# Virtual clock for the in-memory transport
+# Time only moves when advance() or runUntil() is called, so timeouts, ping intervals and latency are deterministic.
+# runUntil() is a discrete event loop over the registered threads: time only moves once every one of them is blocked
+# on the clock, and then straight to the earliest time one of them can wake up.
+# A waiting thread waits on a key (the endpoint, queue or connection it is waiting for), it is only woken when its
+# deadline passes or its key changes and it is ready, so moving time does not wake every thread.
+class VirtualClock(object):
+
+  def __init__(self, start=0.0):
+    self.now = start;
+    self.lock = threading.RLock();
+    self.idle = threading.Condition(self.lock); #Notified when every registered thread is blocked or one is removed
+    self.threads = set(); #Registered threads
+    self.waiters = {}; #Maps threads blocked in waitUntil to (deadline, ready, key, condition it waits on, registered)
+    self.keys = {}; #Maps the key of each waiting thread to the thread
+    self.blocked = 0; #Number of registered threads in waiters
+    self.deadlines = []; #Heap of (deadline, order, thread, condition) for waiting threads (stale entries are skipped)
+    self.events = []; #Heap of (time, order, key) when a queued message becomes deliverable to key
+    self.order = itertools.count();
+
+  def time(self):
+    return self.now;
+
+  # Wake a waiting thread, called with lock held
+  def wake(self, thread):
+    deadline, ready, key, cond, registered = self.waiters.pop(thread);
+    self.keys.pop(key, None);
+    self.blocked -= registered;
+    cond.notify();
+
+  # Wake the thread waiting on key if it is now ready, called with lock held after anything it checks changes
+  def changed(self, key):
+    thread = self.keys.get(key);
+    if thread is not None and self.waiters[thread][1]():
+      self.wake(thread);
+
+  # Add a time the thread waiting on key may become ready at (a message delivery time)
+  def schedule(self, at, key):
+    with self.lock:
+      heapq.heappush(self.events, (at, next(self.order), key));
+
+  # Earliest deadline of a waiting thread (or None), dropping deadlines of threads that are no longer waiting on them
+  def nextDeadline(self):
+    while self.deadlines:
+      deadline, order, thread, cond = self.deadlines[0];
+      if thread in self.waiters and self.waiters[thread][3] is cond:
+        return deadline;
+      heapq.heappop(self.deadlines);
+    return None;
+
+  # Move the clock to at, waking the threads whose deadline passed or whose messages became deliverable
+  def moveTo(self, at):
+    with self.lock:
+      self.now = at;
+
+      while self.events and self.events[0][0] <= self.now:
+        self.changed(heapq.heappop(self.events)[2]);
+
+      deadline = self.nextDeadline();
+      while deadline is not None and deadline <= self.now:
+        self.wake(heapq.heappop(self.deadlines)[2]);
+        deadline = self.nextDeadline();
+
+  def advance(self, secs):
+    self.moveTo(self.now + secs);
+
+  # Register a thread (before it is started) so runUntil waits for it to block before moving time
+  def addThread(self, thread):
+    with self.lock:
+      self.threads.add(thread);
+
+  # Unregister a thread (when it finishes)
+  def removeThread(self, thread):
+    with self.lock:
+      self.threads.discard(thread);
+      self.idle.notify_all();
+
+  # Advance the clock to end, each step waits until every registered thread is blocked and then moves time
+  # to the earliest deadline or message delivery time
+  def runUntil(self, end):
+    with self.lock:
+      while True:
+        while self.blocked < len(self.threads):
+          self.idle.wait();
+
+        if self.now >= end:
+          return;
+
+        times = [end];
+        deadline = self.nextDeadline();
+        if deadline is not None:
+          times.append(deadline);
+        if self.events:
+          times.append(self.events[0][0]);
+        self.moveTo(max(min(times), self.now));
+
+  # Block until ready() is true or the clock reaches deadline, returns ready()
+  # key - what ready() checks (changed(key) is called when it changes), None if only the deadline can wake the thread
+  def waitUntil(self, deadline, ready=lambda: False, key=None):
+    thread = threading.current_thread();
+    with self.lock:
+      if not ready() and self.now < deadline:
+        registered = thread in self.threads;
+        cond = threading.Condition(self.lock);
+        self.waiters[thread] = (deadline, ready, key, cond, registered);
+        if key is not None:
+          self.keys[key] = thread;
+        heapq.heappush(self.deadlines, (deadline, next(self.order), thread, cond));
+        self.blocked += registered;
+        if self.blocked == len(self.threads):
+          self.idle.notify_all();
+
+        while thread in self.waiters:
+          cond.wait();
+
+      return ready();
+
+  def sleep(self, secs):
+    self.waitUntil(self.now + secs);
+
+
+# In-memory listening endpoint, holds a heap of (deliveryTime, message, order, data) entries
+# (messages delivered at the same time are received in message order, whichever sender ran first)
+class MemoryEndpoint(object):
+
+  def __init__(self, clock, timeout):
+    self.clock = clock;
+    self.timeout = timeout;
+    self.queue = [];
+
+  def settimeout(self, timeout):
+    self.timeout = timeout;
+
+  def ready(self):
+    return len(self.queue) > 0 and self.queue[0][0] <= self.clock.time();
+
+  def pop(self):
+    if not self.clock.waitUntil(self.clock.time() + self.timeout, self.ready, self):
+      raise socket.timeout("timed out");
+    with self.clock.lock:
+      return heapq.heappop(self.queue)[3];
+
+  def recvfrom(self, bufsize):
+    data, addr = self.pop();
+    return data[:bufsize], addr;
+
+  def accept(self):
+    return self.pop();
+
+  def close(self):
+    pass;
+
+
+# Single message in-memory stream connection (every sendStream call opens a new connection)
+class MemoryConnection(object):
+
+  def __init__(self, clock, data):
+    self.clock = clock;
+    self.data = data;
+    self.reply = "";
+    self.closed = False;
+
+  def settimeout(self, timeout):
+    pass;
+
+  def recv(self, bufsize):
+    chunk = self.data[:bufsize];
+    self.data = self.data[bufsize:];
+    return chunk;
+
+  def send(self, data):
+    self.reply += str(data);
+    return len(data);
+
+  def close(self):
+    with self.clock.lock:
+      self.data = "";
+      self.closed = True;
+      self.clock.changed(self);
+
+
+# In-process transport, messages are delivered through per port queues on a virtual clock
+# loss - probability [0, 1] that a message is dropped (datagrams vanish, stream connects fail)
+# datagramLoss - probability that a datagram is dropped if it differs from loss (eg. 0 to only lose file transfer messages)
+# latency - seconds (virtual) between send and delivery
+# seed - seed that decides which messages are lost so runs are reproducible
+class MemoryTransport(object):
+
+  def __init__(self, clock=None, loss=0.0, latency=0.0, seed=None, datagramLoss=None):
+    self.clock = clock or VirtualClock();
+    self.loss = loss;
+    self.datagramLoss = datagramLoss;
+    self.latency = latency;
+    self.seed = seed;
+    self.rand = random.Random(seed);
+    self.order = 0;
+    self.datagramEndpoints = {};
+    self.streamEndpoints = {};
+
+  def time(self):
+    return self.clock.time();
+
+  def sleep(self, secs):
+    self.clock.sleep(secs);
+
+  def listen(self, endpoints, port, timeout):
+    if port in endpoints:
+      raise socket.error("address already in use");
+    endpoints[port] = MemoryEndpoint(self.clock, timeout);
+    return endpoints[port];
+
+  def listenDatagram(self, ip, port, timeout):
+    return self.listen(self.datagramEndpoints, port, timeout);
+
+  def listenStream(self, ip, port, timeout, backlog):
+    return self.listen(self.streamEndpoints, port, timeout);
+
+  # Stop delivering to port, messages still queued there are lost (simulates the peer listening there crashing)
+  def unbind(self, port):
+    with self.clock.lock:
+      self.datagramEndpoints.pop(port, None);
+      self.streamEndpoints.pop(port, None);
+
+  # Check if message sent to port now is lost. With a seed this only depends on the seed, port, message and time,
+  # not on the order concurrent senders happen to run in
+  def isLost(self, port, message, loss):
+    if loss <= 0:
+      return False;
+    rand = self.rand if self.seed is None else random.Random(hash((self.seed, port, message, self.clock.time())));
+    return rand.random() < loss;
+
+  # Queue item (carrying message) on the endpoint listening at port, returns False if it was not delivered
+  def deliver(self, endpoints, port, message, item):
+    with self.clock.lock:
+      loss = self.loss;
+      if endpoints is self.datagramEndpoints and self.datagramLoss is not None:
+        loss = self.datagramLoss;
+
+      if port not in endpoints or self.isLost(port, message, loss):
+        return False;
+      self.order += 1;
+      heapq.heappush(endpoints[port].queue, (self.clock.time() + self.latency, message, self.order, item));
+      self.clock.schedule(self.clock.time() + self.latency, endpoints[port]);
+      self.clock.changed(endpoints[port]);
+      return True;
+
+  def sendDatagram(self, message, targetIP, targetPort):
+    self.deliver(self.datagramEndpoints, targetPort, str(message), (str(message), (targetIP, targetPort)));
+
+  def sendStream(self, message, targetIP, targetPort, awaitReply=False):
+    conn = MemoryConnection(self.clock, str(message));
+    if not self.deliver(self.streamEndpoints, targetPort, str(message), (conn, (targetIP, targetPort))):
+      raise socket.error("connection refused");
+
+    #Wait for the receiver to close the connection, the reply takes latency to travel back
+    if not awaitReply:
+      return "";
+    if self.clock.waitUntil(self.clock.time() + self.latency + FILEMONITOR_TIMEOUT, lambda: conn.closed, conn):
+      self.clock.sleep(self.latency);
+    return conn.reply;
+
+  def putQueued(self, queue, item):
+    with self.clock.lock:
+      queue.put_nowait(item);
+      self.clock.changed(queue);
+
+  def getQueued(self, queue, timeout):
+    if not self.clock.waitUntil(self.clock.time() + timeout, lambda: not queue.empty(), queue):
+      raise Queue.Empty();
+    return queue.get_nowait();
+
+
+# Active transport used by all peer functions
+transport = SocketTransport();
+
+# Replace the active transport (eg. with a MemoryTransport before starting peer threads)
+def setTransport(newTransport):
+  global transport;
+  transport = newTransport;
+
+
 # Ping Functions (UDP)
 # Sends a single ping to targetIP and targetPort using UDP
 # Message format is as follows:
@@ -539,6 +1586,7 @@ def TCPMonitor(screen, Ping):
 # Sender Identifier - must be sent as each client is also server (cant send ping over listening port).
 # Sequence Number - is sent so detection of dead peers is possible
 
+@timed("send.ping")
 def sendPing(msgType, seqNum, sourceID, targetIP, targetPort):
   #start with default ping request message
   message = bytearray([msgType]);
@@ -550,16 +1598,18 @@ def sendPing(msgType, seqNum, sourceID, targetIP, targetPort):
   message.extend( struct.pack("H", seqNum));  #unsigned short
 
   #Send UDP datagram
-  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); #UDP
-  sock.settimeout(PINGREQ_TIMEOUT);
-  sock.sendto(message, (targetIP, targetPort));
+  transport.sendDatagram(message, targetIP, targetPort);
 
 # File Transfer Messages (TCP)
 # Send or forward a file transfer message
 # Message Type - 0x00 for file request, 0x01 for forwarded message, 0x02 for file request response
 # Sender Identifier - identifier for sender of original FT message
 # File hash - identifier (hash) of requested file
-def sendFTMessage(filehash, msgType, sourceID, targetIP, targetPort):
+# Trace (optional) - trace ID and hop timestamps, see packTrace
+# File requests (REQ, FORWARD, FORWARDNEXT) wait for the receiver to accept them, the receiver's reply is returned
+# (empty if the request was accepted, a busy reply if the receiver is overloaded, None if the receiver could not be reached)
+@timed("send.ft")
+def sendFTMessage(filehash, msgType, sourceID, targetIP, targetPort, trace=None):
   #start with message type
   message = bytearray([msgType]);
 
@@ -569,18 +1619,274 @@ def sendFTMessage(filehash, msgType, sourceID, targetIP, targetPort):
   #append the file hash
   message.extend( struct.pack("H", filehash));  #unsigned short
 
+  #append trace information
+  if trace is not None:
+    message.extend(packTrace(trace));
+
   #Send TCP message to target
   try:
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM);
-    sock.connect((targetIP, targetPort));
-    sock.send(message);
-    sock.close();
+    return transport.sendStream(message, targetIP, targetPort, msgType != FT.RES);
+  except socket.error:
+    return None;
+
+
+# Trace information (optional trailer on FT messages)
+# Trace ID - unsigned int identifying the request across all peers
+# Hop Count - number of hops that follow (byte)
+# Hops - (peer identifier byte, send time double) for every peer that sent the message so far
+def packTrace(trace):
+  traceID, hops = trace;
+
+  message = bytearray(struct.pack("I", traceID)); #unsigned int
+  message.extend( struct.pack("B", len(hops))); #byte
+
+  for peerID, sentAt in hops:
+    message.extend( struct.pack("B", peerID)); #byte
+    message.extend( struct.pack("d", sentAt)); #double
+
+  return message;
+
+# Get trace information from a received FT message, None if message is not traced
+# (a trailer that is shorter than its hop count says is treated as untraced)
+@timed("parse.trace")
+def unpackTrace(data):
+  if len(data) < 9:
+    return None;
+
+  traceID = int(struct.unpack("I", data[4:8])[0]); #get trace ID
+  hopCount = int(struct.unpack("B", data[8])[0]); #get number of hops
+  if len(data) < 9 + 9 * hopCount:
+    return None;
+
+  hops = [];
+  for i in range(0, hopCount):
+    offset = 9 + i * 9;
+    peerID = int(struct.unpack("B", data[offset])[0]);
+    sentAt = float(struct.unpack("d", data[offset + 1:offset + 9])[0]);
+    hops.append((peerID, sentAt));
+
+  return (traceID, hops);
+
+# Return a copy of trace with this peer added as the latest hop (None if message is not traced)
+def addTraceHop(trace):
+  if trace is None:
+    return None;
+
+  traceID, hops = trace;
+  if len(hops) >= TRACE_MAX_HOPS:
+    return trace;
+
+  return (traceID, hops + [(myPeer, transport.time())]);
+
+# Append a span record for a traced FT message handled at this peer to the local trace log
+# event - request (sent by requester), forward, owner (file is stored here) or response (received by requester)
+# recvTime - time message arrived at this peer (None for request spans)
+# nextPeer - peer the message was sent on to
+@timed("trace.write")
+def writeTraceSpan(trace, event, filehash, recvTime, nextPeer):
+  if trace is None:
+    return;
+
+  traceID, hops = trace;
+
+  span = {
+    "trace": "%08x" % traceID,
+    "peer": myPeer,
+    "event": event,
+    "file": str(filehash).zfill(4),
+    "prev": hops[-1][0] if hops else PEER.INVALID,
+    "prevSentAt": hops[-1][1] if hops else None,
+    "startAt": hops[0][1] if hops else transport.time(),
+    "recvAt": recvTime,
+    "doneAt": transport.time(),
+    "to": nextPeer,
+    "hop": len(hops)
+  };
+
+  with traceLock:
+    try:
+      with open(TRACE_LOG_FORMAT.format(myPeer), "a") as f:
+        f.write(json.dumps(span, sort_keys=True) + "\n");
+    except IOError:
+      pass;
+
+traceLock = threading.Lock(); #Serialises trace log writes from the input and TCP threads
+
+# Send a file request (REQ, FORWARD or FORWARDNEXT) to targetPeer, honouring busy replies
+# A busy (or unreachable) first successor is skipped by sending the request to the second successor when the first
+# successor is not the file owner. Otherwise the request is deferred and retried with jittered exponential backoff.
+# token - pending request token when this peer is the requester (None when forwarding), passed on to retries
+# Returns the peer the request was sent to, or PEER.INVALID if it was deferred or dropped
+def sendFTRequest(screen, filehash, msgType, sourceID, targetPeer, trace, attempt=0, token=None):
+  reply = sendFTMessage(filehash, msgType, sourceID, LOCALHOST, peerToPort(targetPeer), trace);
+  if isAcceptedReply(reply):
+    return targetPeer;
+
+  #An unreachable peer (eg. one that has just left) is retried after the default busy time
+  if reply is None:
+    reason = ") could not be reached.";
+    retryAfter = BUSY_RETRY_AFTER;
+  else:
+    reason = ") is busy.";
+    retryAfter = int(struct.unpack("H", reply[4:6])[0]) / 1000.0; #get retry-after time (ms)
+
+  #Route around a busy first successor when it would only forward the request
+  if msgType != FT.FORWARDNEXT and targetPeer == succ1 and succ2 >= 0:
+    hashedPeer = int(filehash) % (MAXPEERNUM + 1);
+    altType = FT.FORWARDNEXT if betweenPeers(hashedPeer, succ1, succ2) else (FT.PROBE if msgType == FT.PROBE else FT.FORWARD);
+
+    if isAcceptedReply(sendFTMessage(filehash, altType, sourceID, LOCALHOST, peerToPort(succ2), trace)):
+      consolePrint(screen, CONTROL.WARNING, "Peer (" + makeColComp(Colours.GREEN, str(targetPeer)) + reason + " File request message for " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " has been sent to Peer (" + makeColComp(Colours.GREEN, str(succ2)) + ") instead.");
+      return succ2;
+
+  if attempt >= BUSY_MAX_RETRIES:
+    if token is not None:
+      dropPendingRequest(filehash, token);
+    consolePrint(screen, CONTROL.WARNING, "Peer (" + makeColComp(Colours.GREEN, str(targetPeer)) + reason + " File request message for " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " has been dropped after " + str(attempt) + " retries.");
+    return PEER.INVALID;
+
+  #Exponential backoff from the retry-after time, with jitter so deferred senders do not retry together
+  delay = retryAfter * (2 ** attempt) * rand.uniform(1 - BUSY_JITTER, 1 + BUSY_JITTER);
+  deferRetry(transport.time() + delay, (filehash, msgType, sourceID, targetPeer, trace, attempt + 1, token));
+  consolePrint(screen, CONTROL.WARNING, "Peer (" + makeColComp(Colours.GREEN, str(targetPeer)) + reason + " File request message for " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " will be retried in " + ("%.2f" % delay) + " seconds.");
+  return PEER.INVALID;
+
+# Send a file response to the requesting peer targetPeer. A response that could not be delivered is deferred and
+# resent with the same backoff as a busy request, so losing it does not lose the whole request
+# Returns True if the response was sent
+def sendFTResponse(screen, filehash, targetPeer, trace, attempt=0):
+  if sendFTMessage(filehash, FT.RES, myPeer, LOCALHOST, peerToPort(targetPeer), trace) is not None:
+    return True;
+
+  if attempt >= BUSY_MAX_RETRIES:
+    consolePrint(screen, CONTROL.WARNING, "Peer (" + makeColComp(Colours.GREEN, str(targetPeer)) + ") could not be reached. Response message for " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " has been dropped after " + str(attempt) + " retries.");
+    return False;
+
+  delay = BUSY_RETRY_AFTER * (2 ** attempt) * rand.uniform(1 - BUSY_JITTER, 1 + BUSY_JITTER);
+  deferRetry(transport.time() + delay, (filehash, FT.RES, myPeer, targetPeer, trace, attempt + 1, None));
+  consolePrint(screen, CONTROL.WARNING, "Peer (" + makeColComp(Colours.GREEN, str(targetPeer)) + ") could not be reached. Response message for " + makeColComp(Colours.RED, str(filehash).zfill(4)) + " will be retried in " + ("%.2f" % delay) + " seconds.");
+  return False;
+
+# Busy reply (TCP, sent back over the connection of a rejected file request)
+# Message Type - FT.BUSY
+# Sender Identifier - identifier of the busy peer
+# File hash - identifier (hash) of rejected file request
+# Retry After - milliseconds the sender should wait before retrying
+def makeBusyMessage(filehash):
+  message = bytearray([FT.BUSY]);
+  message.extend( struct.pack("B", myPeer)); #byte
+  message.extend( struct.pack("H", filehash)); #unsigned short
+  message.extend( struct.pack("H", int(BUSY_RETRY_AFTER * 1000))); #unsigned short
+  return message;
+
+# Check if a reply to a file request is a busy reply
+def isBusyReply(reply):
+  return reply is not None and len(reply) >= 6 and ord(reply[0]) == FT.BUSY;
+
+# Check if a reply to a file request means the receiver accepted it (it was reachable and not busy)
+def isAcceptedReply(reply):
+  return reply is not None and not isBusyReply(reply);
+
+
+# Key summaries (Bloom filters)
+# Each peer keeps a bounded store of extra keys it holds (replicas placed with the store command and cached
+# copies of files it received responses for) and periodically sends a Bloom filter of them to its successors
+# and predecessors. Forwarding peers use the filters of their neighbours to send a request straight to a likely holder.
+
+# Bit positions of filehash in a key summary
+def bloomPositions(filehash):
+  digest = hashlib.md5(str(int(filehash))).digest();
+  return [int(struct.unpack("I", digest[i * 4:i * 4 + 4])[0]) % BLOOM_BITS for i in range(0, BLOOM_HASHES)];
+
+# Build a key summary (Bloom filter) of the given keys
+def makeKeySummary(keys):
+  summary = bytearray(BLOOM_BITS / 8);
+  for key in keys:
+    for pos in bloomPositions(key):
+      summary[pos / 8] |= 1 << (pos % 8);
+  return summary;
+
+# Check if a key summary may contain filehash (false positives are possible, false negatives are not)
+def summaryContains(summary, filehash):
+  for pos in bloomPositions(filehash):
+    if not summary[pos / 8] & (1 << (pos % 8)):
+      return False;
+  return True;
+
+# Add filehash to this peers key store, evicting the oldest key when the store is full
+# expiry - time a cached copy is forgotten, None for a replica (a cached copy never replaces a replica)
+def storeKey(filehash, expiry=None):
+  with storeLock:
+    previous = storedKeys.pop(int(filehash), expiry);
+    storedKeys[int(filehash)] = None if previous is None else expiry;
+    while len(storedKeys) > STORE_MAX_KEYS:
+      storedKeys.popitem(False);
+    expireCachedKeys();
+
+# Forget expired cached copies and rebuild this peers key summary, storeLock must be held
+def expireCachedKeys():
+  global keySummary;
+
+  now = transport.time();
+  for key, expiry in storedKeys.items():
+    if expiry is not None and expiry <= now:
+      del storedKeys[key];
+
+  keySummary = makeKeySummary(storedKeys.keys());
+
+# Check if filehash is in this peers key store
+# includeCached - also accept an unexpired cached copy (not just a replica)
+def isKeyStored(filehash, includeCached=True):
+  with storeLock:
+    if int(filehash) not in storedKeys:
+      return False;
+    expiry = storedKeys[int(filehash)];
+
+  return expiry is None or (includeCached and expiry > transport.time());
+
+# Find a current neighbour whose (recent) key summary may contain filehash
+# Returns the neighbours peer ID or PEER.INVALID if no summary matches
+def findKeyHolder(filehash):
+  for peerID in (succ1, succ2, pred1, pred2):
+    if peerID < 0 or peerID == myPeer or peerID not in neighbourSummaries:
+      continue;
+
+    summary, receivedAt = neighbourSummaries[peerID];
+    if transport.time() - receivedAt <= SUMMARY_EXPIRY and summaryContains(summary, filehash):
+      return peerID;
+
+  return PEER.INVALID;
+
+storedKeys = collections.OrderedDict(); #Maps keys stored at this peer (in insertion order) to their cache expiry time (None for replicas)
+storeLock = threading.Lock();
+keySummary = makeKeySummary([]); #Bloom filter of storedKeys sent to neighbours
+neighbourSummaries = {}; #Maps neighbour peer ID to (key summary, time received)
+
+# Key Summary Message (TCP)
+# Message Type - FT.SUMMARY
+# Sender Identifier - identifier of the peer the summary describes
+# Summary - BLOOM_BITS bit Bloom filter of the keys stored at the sender
+@timed("send.summary")
+def sendSummaryMessage(summary, sourceID, targetIP, targetPort):
+  #start with message type
+  message = bytearray([FT.SUMMARY]);
+
+  #append senders peer identifier
+  message.extend( struct.pack("B", sourceID));  #byte
+
+  #append the summary
+  message.extend(summary);
+
+  #Send TCP message to target
+  try:
+    transport.sendStream(message, targetIP, targetPort);
   except socket.error:
     pass;
 
 
 # Peer Churn Graceful Exit Message (TCP)
 # Send a message to predecessors informing them of exit or querying for information
+@timed("send.churn")
 def sendChurnMessage(msgType, succ1, succ2, sourceID, targetIP, targetPort):
   #start with message type
   message = bytearray([msgType]);
@@ -596,35 +1902,36 @@ def sendChurnMessage(msgType, succ1, succ2, sourceID, targetIP, targetPort):
 
   #Send TCP message to target
   try:
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM);
-    sock.connect((targetIP, targetPort));
-    sock.send(message);
-    sock.close();
+    transport.sendStream(message, targetIP, targetPort);
   except socket.error:
     pass;
 
 #Checks if file is available here
 #Returns values to say if file should be forwarded, if file is available here 
 #or if file will be available at the next peer
-def checkFileAvailable(filehash):
+#includeCached - count a cached copy as available (only for requests forwarded from other peers)
+def checkFileAvailable(filehash, includeCached=True):
   hashedPeer = int(filehash) % (MAXPEERNUM + 1);
 
-  #Check if current peer holds file
-  if hashedPeer == myPeer:
+  #Check if current peer holds file (or a replica or cached copy of it)
+  if hashedPeer == myPeer or isKeyStored(filehash, includeCached):
     return FILECHECK.AVAILABLE;
 
-  #Check special wrap around case where file is available at next peer
-  if succ1 < myPeer:
-    if myPeer < hashedPeer <= MAXPEERNUM or 0 <= hashedPeer <= succ1:
-      return FILECHECK.NEXTAVAILABLE;
-
-  #Check if immediate successor will have file (non wrap around case)
-  if myPeer < hashedPeer <= succ1:
+  #Check if immediate successor will have file
+  if betweenPeers(hashedPeer, myPeer, succ1):
     return FILECHECK.NEXTAVAILABLE;
 
   #Otherwise, we do not know where file is stored and request must be forwarded
   return FILECHECK.NOTAVAILABLE;
 
+#Checks if peerID lies in the ring interval (startPeer, endPeer], accounting for wrap around
+def betweenPeers(peerID, startPeer, endPeer):
+  #Special wrap around case
+  if endPeer < startPeer:
+    return startPeer < peerID <= MAXPEERNUM or 0 <= peerID <= endPeer;
+
+  return startPeer < peerID <= endPeer;
+
 # Convert peer ID to the port the peer will be using to listen for messages
 def peerToPort(peerID):
   return BASE_PORT_OFFSET + int(peerID);
@@ -635,6 +1942,7 @@ def makeColComp(colour, text):
 
 # console print helper function
 # highlights control codes and converts colour components to coloured text
+@timed("console.printLine")
 def consolePrintLine (screen, pos, control, message):
   # Print different colours for different control messages
   if control == CONTROL.WARNING:
@@ -696,6 +2004,7 @@ def consolePrintLine (screen, pos, control, message):
 
 
 # Prints a control message and info message to the given screen
+@timed("console.print")
 def consolePrint (screen, control, message):
 
   #Check if print should be omitted
@@ -0,0 +1,303 @@
+#
+# COMP3331 - Socket Programming Assignment
+#
+# Simulation harness for the Circular DHT Program (cdht_ex).
+#
+# Runs a whole CDHT network inside one process on a MemoryTransport driven by a VirtualClock, so lookups,
+# message loss, latency and peer churn can be exercised without sockets, curses or waiting in real time.
+# Peer state in cdht_ex is module global, so every simulated peer is its own copy of the cdht_ex module
+# (loaded under the name cdht_peer_N) sharing the one transport. Console output goes to a stub screen per peer.
+# Every peer thread is registered with the clock, which only moves once all of them are blocked on it, so a run
+# with the same seed takes the same steps however fast the machine is.
+#
+# Tested and developed on: Python 2.7
+#
+
+#! /usr/bin/python
+
+import sys
+import os
+import re
+import imp
+import random
+import threading
+
+#Definitions
+PEER_MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cdht_ex.py"); #Module loaded once per simulated peer
+LOOKUP_STEP = 0.01; #Virtual seconds between checks for the result of a lookup
+SETTLE_TIME = 12.0; #Virtual seconds to run a new network for so every peer learns its predecessors
+LOOKUP_TIMEOUT = 30.0; #Virtual seconds to wait for the response to a lookup
+CHURN_TIME = 30.0; #Virtual seconds to run after a peer is killed so its predecessors replace it
+COLOUR_TAG = re.compile("colour\d\[(.*?)\]"); #Colour components in console messages
+
+# Stand in control client, records the events sent for file requests made with it
+class SimClient(object):
+
+  def __init__(self):
+    self.events = [];
+
+  def send(self, reply):
+    self.events.append(reply);
+
+# Stub curses screen, records the console output of one peer as (virtual time, control code, text) lines
+class SimScreen(object):
+
+  def __init__(self, clock):
+    self.clock = clock;
+    self.lines = [];
+
+  def log(self, control, message):
+    self.lines.append((self.clock.time(), control, COLOUR_TAG.sub(r"\1", message)));
+
+# Replacement for consolePrint in every simulated peer
+def simConsolePrint(screen, control, message):
+  screen.log(control, message);
+
+# Raised in the threads of a crashed peer
+class PeerKilled(Exception):
+  pass;
+
+# View of the shared transport used by one peer, once the peer is killed every transport call its threads make
+# raises PeerKilled so they stop at a safe point (never while holding a lock of the shared clock). Every blocking
+# call of a peer thread (including waiting on its work queue) goes through the transport, so all of them stop.
+class PeerTransport(object):
+
+  def __init__(self, transport):
+    self.transport = transport;
+    self.killed = False;
+
+  def __getattr__(self, name):
+    if self.killed:
+      raise PeerKilled();
+    return getattr(self.transport, name);
+
+  # Listening endpoints are wrapped as well so blocked monitor threads also stop
+  def listenDatagram(self, ip, port, timeout):
+    return PeerEndpoint(self, self.transport.listenDatagram(ip, port, timeout));
+
+  def listenStream(self, ip, port, timeout, backlog):
+    return PeerEndpoint(self, self.transport.listenStream(ip, port, timeout, backlog));
+
+# Listening endpoint of a peer, raises PeerKilled once the peer is killed
+class PeerEndpoint(object):
+
+  def __init__(self, peerTransport, endpoint):
+    self.peerTransport = peerTransport;
+    self.endpoint = endpoint;
+
+  def __getattr__(self, name):
+    if self.peerTransport.killed:
+      raise PeerKilled();
+    return getattr(self.endpoint, name);
+
+# Run a peer thread target until the peer is killed, the thread is unregistered from clock when it finishes
+def runPeerThread(clock, target, *args):
+  try:
+    target(*args);
+  except PeerKilled:
+    pass;
+  finally:
+    clock.removeThread(threading.current_thread());
+
+# One simulated peer, its cdht_ex module copy, transport view, stub screen and running threads
+class SimPeer(object):
+
+  def __init__(self, module, transport, screen, threads):
+    self.module = module;
+    self.transport = transport;
+    self.screen = screen;
+    self.threads = threads;
+
+  # Start target(*args) as a daemon thread of this peer, registered with clock
+  def startThread(self, clock, name, target, *args):
+    thread = threading.Thread(target=runPeerThread, args=(clock, target) + args, name=name + "-" + str(self.module.myPeer));
+    thread.daemon = True;
+    clock.addThread(thread);
+    thread.start();
+    self.threads.append(thread);
+
+# CDHT network of simulated peers sharing one MemoryTransport
+class SimNetwork(object):
+
+  def __init__(self, peerIDs, loss=0.0, latency=0.0, seed=None):
+    self.peerIDs = sorted(peerIDs);
+    self.peers = {};
+    self.seed = seed;
+
+    # The transport classes are taken from a throwaway copy so no peer owns the shared clock
+    self.base = imp.load_source("cdht_sim_base", PEER_MODULE);
+    self.transport = self.base.MemoryTransport(loss=loss, latency=latency, seed=seed);
+
+    for i, peerID in enumerate(self.peerIDs):
+      self.start(peerID, self.peerIDs[(i + 1) % len(self.peerIDs)], self.peerIDs[(i + 2) % len(self.peerIDs)]);
+
+  # Start peerID with the given successors (the same set up init and main do for a real peer)
+  def start(self, peerID, succ1, succ2):
+    module = imp.load_source("cdht_peer_" + str(peerID), PEER_MODULE);
+    transport = PeerTransport(self.transport);
+    module.setTransport(transport);
+    module.consolePrint = simConsolePrint;
+    module.myPeer = peerID;
+    module.succ1 = succ1;
+    module.succ2 = succ2;
+    module.pred1 = module.PEER.INVALID;
+    module.pred2 = module.PEER.INVALID;
+    module.showPingMessages = False;
+    module.traceRequests = False;
+    module.rand.seed(hash((self.seed, peerID))); #each peer has its own backoff jitter
+
+    screen = SimScreen(self.transport.clock);
+    peer = SimPeer(module, transport, screen, []);
+    self.peers[peerID] = peer;
+    self.startThread(peer, "pingMonitor", module.pingMonitor, screen, module.Ping);
+    self.startThread(peer, "TCPMonitor", module.TCPMonitor, screen, module.Ping);
+    self.startThread(peer, "TCPWorker", module.TCPWorker, screen);
+
+  # Start target(*args) as a thread of peer
+  def startThread(self, peer, name, target, *args):
+    peer.startThread(self.transport.clock, name, target, *args);
+
+  # Run the network for secs virtual seconds
+  def run(self, secs):
+    self.transport.clock.runUntil(self.transport.time() + secs);
+
+  # File name (number) that hashes to peerID, n picks one of the files that do
+  def fileFor(self, peerID, n):
+    return peerID + n * (self.base.MAXPEERNUM + 1);
+
+  # Peer that owns filehash (the first peer at or after the file hash on the ring)
+  def owner(self, filehash):
+    hashedPeer = filehash % (self.base.MAXPEERNUM + 1);
+    for peerID in self.peerIDs:
+      if peerID >= hashedPeer:
+        return peerID;
+    return self.peerIDs[0];
+
+  # Number of file requests the worker threads of all peers have handled
+  def handledRequests(self):
+    return sum(stats["count"] for peer in self.peers.values()
+               for name, stats in peer.module.getTimings().items() if name.startswith("worker."));
+
+  # Request filehash from peerID (as a control client would) and run the clock until the request completes
+  # Returns the event the request completed with (response, dropped or timeout, see controlMonitor) with the number
+  # of file requests peers handled on the way added as hops, or None if nothing arrived within timeout
+  def lookup(self, peerID, filehash, timeout=LOOKUP_TIMEOUT):
+    peer = self.peers[peerID];
+    client = SimClient();
+    handled = self.handledRequests();
+    start = self.transport.time();
+
+    # requestFile blocks on the virtual clock while its message is in flight, so it runs on its own thread
+    self.startThread(peer, "request", peer.module.requestFile, peer.screen, filehash, client, filehash);
+
+    while not client.events and self.transport.time() - start < timeout:
+      self.run(LOOKUP_STEP);
+
+    if not client.events:
+      return None;
+
+    event = dict(client.events[0]);
+    event["hops"] = self.handledRequests() - handled;
+    return event;
+
+  # Crash peerID (ungraceful churn), nothing is delivered to it any more and its threads stop
+  # at their next transport call (within a monitor timeout once the clock moves on)
+  # Returns the threads of the killed peer
+  def kill(self, peerID):
+    peer = self.peers.pop(peerID);
+    self.peerIDs.remove(peerID);
+    peer.transport.killed = True;
+    self.transport.unbind(peer.module.peerToPort(peerID));
+    return peer.threads;
+
+  # Successors each peer currently knows about
+  def successors(self):
+    return dict((peerID, (peer.module.succ1, peer.module.succ2)) for peerID, peer in self.peers.items());
+
+  # Stop all peers, running the clock until their threads have finished
+  def stop(self):
+    threads = [];
+    for peerID in list(self.peerIDs):
+      threads.extend(self.kill(peerID));
+
+    while any(thread.is_alive() for thread in threads):
+      self.run(LOOKUP_STEP);
+
+# Print and count the result of a scenario check
+def check(results, name, ok, detail):
+  results.append(ok);
+  print ("ok  " if ok else "FAIL") + " " + name + ": " + detail;
+
+# Run a lookup and check the file owner responded
+def checkLookup(results, name, network, peerID, filehash):
+  event = network.lookup(peerID, filehash);
+  if event is None or event["event"] != "response":
+    check(results, name, False, "no response for " + str(filehash).zfill(4) + " within " + str(LOOKUP_TIMEOUT) + " virtual seconds" +
+          ("" if event is None else " (request " + event["event"] + ")"));
+    return;
+
+  check(results, name, event["peer"] == network.owner(filehash),
+        "Peer (" + str(peerID) + ") got " + str(filehash).zfill(4) + " from Peer (" + str(event["peer"]) + ") after " +
+        str(event["hops"]) + " hops in " + ("%.3f" % (event["elapsed"] / 1000.0)) + " virtual seconds");
+
+# Run the lookup, loss and churn scenarios on a simulated network
+# usage: cdht_sim.py [--peers N] [--loss P] [--latency S] [--seed N]
+def main(argv):
+  options = {"--peers": 16, "--loss": 0.2, "--latency": 0.01, "--seed": 1};
+
+  i = 0;
+  while i < len(argv):
+    if argv[i] in options and i + 1 < len(argv):
+      try:
+        options[argv[i]] = type(options[argv[i]])(argv[i + 1]);
+      except ValueError:
+        options = None;
+        break;
+      i += 2;
+    else:
+      options = None;
+      break;
+
+  if options is None or not 4 <= options["--peers"] <= 256:
+    print >> sys.stderr, 'usage:', sys.argv[0], '[--peers N] [--loss P] [--latency S] [--seed N]';
+    return 2;
+
+  rand = random.Random(options["--seed"]);
+  network = SimNetwork(rand.sample(range(0, 256), options["--peers"]), 0.0, options["--latency"], options["--seed"]);
+  network.run(SETTLE_TIME);
+
+  results = [];
+  peerIDs = network.peerIDs;
+  requester = peerIDs[0];
+
+  # Multi-hop lookup for a file owned half way round the ring
+  checkLookup(results, "lookup", network, requester, network.fileFor(peerIDs[len(peerIDs) / 2], 1));
+
+  # Lookup while file transfer messages are being lost (requests are rerouted or retried and responses are retried)
+  # Pings are not lost, enough lost pings make live successors look dead which is not what this checks
+  network.transport.loss = options["--loss"];
+  network.transport.datagramLoss = 0.0;
+  checkLookup(results, "lookup with " + str(options["--loss"]) + " loss", network, requester, network.fileFor(peerIDs[len(peerIDs) / 2 + 1], 2));
+  network.transport.loss = 0.0;
+  network.transport.datagramLoss = None;
+
+  # Crash a peer, its predecessors must replace it and lookups for the files it owned reach its successor
+  victim = peerIDs[len(peerIDs) / 2 - 1];
+  victimIndex = peerIDs.index(victim);
+  pred = peerIDs[victimIndex - 1];
+  network.kill(victim);
+  network.run(CHURN_TIME);
+
+  succ1, succ2 = network.successors()[pred];
+  check(results, "churn", victim not in (succ1, succ2),
+        "Peer (" + str(pred) + ") successors after Peer (" + str(victim) + ") crashed are " + str(succ1) + " and " + str(succ2));
+  checkLookup(results, "lookup after churn", network, requester, network.fileFor(victim, 3));
+
+  network.stop();
+
+  print str(sum(results)) + "/" + str(len(results)) + " checks passed";
+  return 0 if all(results) else 1;
+
+# define program entry point
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,115 @@
+#
+# COMP3331 - Socket Programming Assignment
+#
+# Trace merge tool for the Circular DHT Program (cdht_ex).
+#
+# Merges the span records written by each traced peer (cdht_trace_N.jsonl) into per request hop
+# timelines, showing the network latency into each hop and the processing time spent at each peer.
+#
+# Tested and developed on: Python 2.7
+#
+
+#! /usr/bin/python
+
+import sys
+import glob
+import json
+
+#Definitions
+DEFAULT_LOG_PATTERN = "cdht_trace_*.jsonl"; #Trace logs read when no files are given on the command line
+EVENT_ORDER = {"request": 0, "forward": 1, "retry": 2, "owner": 3, "response": 4}; #Order of spans that share the same hop number
+SPAN_KEYS = ("trace", "peer", "event", "file", "prevSentAt", "startAt", "recvAt", "doneAt", "to", "hop"); #Keys every span record must have
+
+# Load all span records from the given trace logs, grouped by trace ID
+def loadSpans(paths):
+  traces = {};
+
+  for path in paths:
+    with open(path) as f:
+      for lineNum, line in enumerate(f, 1):
+        line = line.strip();
+        if not line:
+          continue;
+
+        try:
+          span = json.loads(line);
+        except ValueError:
+          span = None;
+
+        if not isinstance(span, dict) or any(key not in span for key in SPAN_KEYS):
+          print >> sys.stderr, 'warning: skipping malformed span on line', lineNum, 'of', path;
+          continue;
+
+        traces.setdefault(span["trace"], []).append(span);
+
+  return traces;
+
+# Convert seconds to a millisecond string
+def ms(secs):
+  return "%.3f ms" % (secs * 1000);
+
+# Print the hop timeline and latency breakdown of a single trace
+def printTimeline(traceID, spans):
+  spans = sorted(spans, key=lambda span: (span["hop"], EVENT_ORDER.get(span["event"], len(EVENT_ORDER))));
+  start = min(span["startAt"] for span in spans);
+
+  print "Trace " + traceID + "  file " + spans[0]["file"] + "  requester Peer " + str(spans[0]["peer"] if spans[0]["event"] == "request" else "?");
+
+  totalNet = 0.0;
+  totalProc = 0.0;
+
+  for span in spans:
+    line = "  +" + ms(span["doneAt"] - start).rjust(12) + "  Peer " + str(span["peer"]).ljust(4) + span["event"].ljust(9);
+
+    if span["recvAt"] is not None:
+      net = span["recvAt"] - span["prevSentAt"];
+      proc = span["doneAt"] - span["recvAt"];
+      totalNet += net;
+      totalProc += proc;
+      line += "  net " + ms(net).rjust(12) + "  proc " + ms(proc).rjust(12);
+
+    if span["event"] != "response":
+      line += "  -> Peer " + str(span["to"]);
+
+    print line;
+
+  end = max(span["doneAt"] for span in spans);
+  complete = any(span["event"] == "response" for span in spans);
+
+  print "  total " + ms(end - start) + " (network " + ms(totalNet) + ", processing " + ms(totalProc) + ")" + ("" if complete else " [incomplete]");
+  print;
+
+# Program entry point
+# usage: cdht_trace.py [trace log ...] [--trace ID]
+def main(argv):
+  onlyTrace = None;
+  paths = [];
+
+  i = 0;
+  while i < len(argv):
+    if argv[i] == "--trace" and i + 1 < len(argv):
+      onlyTrace = argv[i + 1];
+      i += 2;
+    else:
+      paths.append(argv[i]);
+      i += 1;
+
+  if not paths:
+    paths = sorted(glob.glob(DEFAULT_LOG_PATTERN));
+
+  if not paths:
+    print >> sys.stderr, 'usage:', sys.argv[0], '[trace log ...] [--trace ID]';
+    exit(1);
+
+  traces = loadSpans(paths);
+
+  # Print traces in the order they were started
+  for traceID in sorted(traces, key=lambda t: min(span["startAt"] for span in traces[t])):
+    if onlyTrace is not None and traceID != onlyTrace:
+      continue;
+    printTimeline(traceID, traces[traceID]);
+
+
+# define program entry point
+if __name__ == "__main__":
+  main(sys.argv[1:])